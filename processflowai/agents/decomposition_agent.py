@@ -1,150 +1,36 @@
-from typing import List
-import google.generativeai as genai
-import json
+from typing import Any, Callable, List, Optional, Set
+from functools import partial
+import ahocorasick
+import asyncio
+from google.generativeai import GenerativeModel
 import logging
-from ..models.process import Process, Document
+import orjson
+import re
+from pydantic import TypeAdapter
+from ..models.process import Process, Document, WORD_RE
+from ..utils.cache import ResponseCache
+from ..utils.gemini_client import get_model
+from ..utils.json_utils import clean_json_string
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-class ContentValidator:
-    pass
+# Validates a whole list of processes in one pydantic-core call
+_PROCESS_LIST_ADAPTER = TypeAdapter(List[Process])
 
-class ProcessDecompositionAgent:
-    def __init__(self, api_key: str):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
-        self.content_validator = ContentValidator()
-        
-    def _clean_json_string(self, text: str) -> str:
-        """Clean and extract JSON from text"""
-        # Remove any markdown code blocks
-        if "```" in text:
-            # Extract content between code blocks
-            parts = text.split("```")
-            if len(parts) >= 3:  # Has opening and closing ```
-                text = parts[1]
-                # Remove language identifier if present
-                if text.startswith("json"):
-                    text = text[4:].strip()
-            else:
-                text = parts[-1].strip()
-        
-        # Ensure we have valid JSON array brackets
-        text = text.strip()
-        if not text.startswith("["):
-            text = "[" + text
-        if not text.endswith("]"):
-            text = text + "]"
-            
-        return text.strip()
-        
-    def _parse_processes(self, json_str: str) -> List[Process]:
-        """Parse JSON string into Process objects with error handling"""
-        logger.debug(f"Attempting to parse JSON: {json_str}")
-        
-        try:
-            processes_data = json.loads(json_str)
-            if not isinstance(processes_data, list):
-                raise ValueError(f"Expected JSON array, got {type(processes_data)}")
-            
-            processes = []
-            for p in processes_data:
-                if not isinstance(p, dict):
-                    raise ValueError(f"Expected dict for process, got {type(p)}")
-                # Ensure required fields
-                p["id"] = p.get("id", str(len(processes)))
-                p["name"] = p.get("name", f"Process {len(processes) + 1}")
-                p["description"] = p.get("description", "No description provided")
-                p["sub_processes"] = p.get("sub_processes", [])
-                
-                # Create phases if they don't exist
-                if "phases" not in p:
-                    p["phases"] = []
-                    phase_map = {}
-                    
-                    # Extract phase information from sub-process IDs
-                    for sub in p["sub_processes"]:
-                        sub_id = sub.get("id", "")
-                        if "_phase" in sub_id:
-                            phase_num = sub_id.split("_phase")[1].split("_")[0]
-                            phase_id = f"{p['id']}_phase{phase_num}"
-                            
-                            if phase_id not in phase_map:
-                                phase_map[phase_id] = {
-                                    "id": phase_id,
-                                    "name": f"Fase {phase_num}",
-                                    "description": f"Fase {phase_num} del proceso",
-                                    "order": int(phase_num),
-                                    "objectives": []
-                                }
-                    
-                    # Add phases in order
-                    p["phases"] = sorted(phase_map.values(), key=lambda x: x["order"])
-                
-                # Ensure each sub-process has required fields
-                for idx, sub in enumerate(p["sub_processes"]):
-                    sub["id"] = sub.get("id", f"{p['id']}_sub_{idx}")
-                    sub["name"] = sub.get("name", f"Step {idx + 1}")
-                    sub["description"] = sub.get("description", "No description provided")
-                    sub["order"] = sub.get("order", idx + 1)
-                    
-                    # Assign phase_id based on sub-process ID pattern
-                    if "_phase" in sub["id"]:
-                        phase_num = sub["id"].split("_phase")[1].split("_")[0]
-                        sub["phase_id"] = f"{p['id']}_phase{phase_num}"
-                    else:
-                        # If no phase in ID, assign to first phase or create one
-                        if not p["phases"]:
-                            default_phase = {
-                                "id": f"{p['id']}_phase1",
-                                "name": "Fase 1",
-                                "description": "Fase principal del proceso",
-                                "order": 1,
-                                "objectives": []
-                            }
-                            p["phases"].append(default_phase)
-                        sub["phase_id"] = p["phases"][0]["id"]
-                
-                processes.append(Process.parse_obj(p))
-            
-            return processes
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
-            logger.error(f"Problematic JSON: {json_str}")
-            raise ValueError(f"Invalid JSON format: {e}")
-        except Exception as e:
-            logger.error(f"Error parsing processes: {e}")
-            logger.error(f"Input data: {json_str}")
-            raise ValueError(f"Error creating processes: {e}")
+# Phase number encoded in a sub-process ID, e.g. "p1_phase2_step1" -> "2"
+_PHASE_RE = re.compile(r"_phase(\d+)")
 
-    def _validate_extraction(self, original_text: str, extracted_info: dict) -> bool:
-        """Validate that extracted information exists in original text"""
-        original_text = original_text.lower()
-        
-        # Check each piece of extracted information
-        for key, value in extracted_info.items():
-            if isinstance(value, str) and value.lower() not in original_text:
-                if value != "No description provided":  # Skip default values
-                    logger.warning(f"Potentially hallucinated content in {key}: {value}")
-                    return False
-        return True
+# Values the analyze prompt tells the model to use for missing data, plus the
+# default filled in by _normalize_process; they are not extracted from the text
+_PLACEHOLDER_VALUES = frozenset({"no especificado", "no especificada", "no description provided"})
+# Fields assigned by the model or the parser rather than copied from the text
+_NON_EXTRACTED_FIELDS = frozenset({"id", "order", "priority", "status"})
 
-    def call_api(self, *args, **kwargs):
-        """Call the Gemini API"""
-        try:
-            return self.model.generate_content(*args, **kwargs)
-        except Exception as e:
-            logger.error(f"API call failed: {str(e)}")
-            raise
-
-    async def analyze_document(self, document: Document) -> List[Process]:
-        """
-        Analyze the document content and extract processes with strict validation.
-        """
-        prompt = f"""
+# Prompt templates. The static instructions come first and the document last,
+# so every request shares the same prefix and only the content is formatted in.
+_ANALYZE_PROMPT_TEMPLATE = """
         Analiza este documento y extrae SOLO los procesos y la información que está EXPLÍCITAMENTE mencionada en el texto.
         
         REGLAS ESTRICTAS:
@@ -154,86 +40,59 @@ class ProcessDecompositionAgent:
         4. Usa EXACTAMENTE la misma terminología que aparece en el texto
         5. Mantén el mismo nivel de detalle que el texto original
         6. Si algo es ambiguo, déjalo tal cual - no intentes clarificarlo
-        
-        Documento a analizar:
-        {document.content}
+        7. Agrupa los pasos en las fases que describe el texto y codifica la fase en el id
+           de cada subproceso con el formato pN_phaseF_stepS (proceso N, fase F, paso S)
         
         Extrae la información en este formato JSON:
         [
-            {{{{
+            {{
                 "id": "process_1",
                 "name": "EXACTAMENTE como aparece en el texto",
                 "description": "SOLO información explícitamente mencionada",
                 "category": "SOLO si está explícitamente mencionado",
                 "sub_processes": [
-                    {{{{
-                        "id": "sub_1",
+                    {{
+                        "id": "p1_phase1_step1",
                         "name": "EXACTAMENTE como aparece en el texto",
                         "description": "SOLO información explícitamente mencionada",
                         "order": "Número basado en el orden en el texto"
-                    }}}}
+                    }}
                 ]
-            }}}}
+            }}
         ]
         
+        Documento a analizar:
+        {content}
         """
-        
-        max_attempts = 3
-        for attempt in range(max_attempts):
-            response = self.call_api(prompt)
-            json_str = self._clean_json_string(response.text)
-            
-            try:
-                processes_data = json.loads(json_str)
-                
-                # Validate each process against original text
-                valid_processes = []
-                for process_data in processes_data:
-                    if self._validate_extraction(document.content, process_data):
-                        valid_processes.append(process_data)
-                    else:
-                        logger.warning(f"Removing invalid process: {process_data['name']}")
-                
-                if valid_processes:
-                    return [Process.parse_obj(p) for p in valid_processes]
-                
-            except (json.JSONDecodeError, ValueError) as e:
-                logger.error(f"Attempt {attempt + 1}: Error processing response - {str(e)}")
-        
-        # If all attempts fail, return an empty list
-        logger.error("Failed to extract valid processes after all attempts")
-        return []
 
-    def analyze_document_sync(self, document: Document) -> List[Process]:
-        """Synchronous version of analyze_document"""
-        prompt = f"""
+_ANALYZE_SYNC_PROMPT_TEMPLATE = """
         Analyze this document and extract all processes as a JSON array. Format the output similar to this example:
         [
-            {{{{
+            {{
                 "id": "process_1",
                 "name": "Implementación y Configuración del Sistema ODU",
                 "description": "Este proceso describe la implementación y configuración del sistema ODU para la gestión de la fabricación...",
                 "category": "Administrativo",
                 "priority": 1,
                 "sub_processes": [
-                    {{{{
+                    {{
                         "id": "p1_phase1_step1",
                         "name": "Acceso al producto",
                         "description": "Ingresar a la sección de 'Productos' dentro del sistema ODU.",
                         "order": 1,
                         "estimated_duration": "15 minutos",
                         "dependencies": []
-                    }}}},
-                    {{{{
+                    }},
+                    {{
                         "id": "p1_phase1_step2",
                         "name": "Seleccionar producto terminado",
                         "description": "Elegir un producto terminado que requiera fabricación (ej: Gtrack Pro).",
                         "order": 2,
                         "estimated_duration": "5 minutos",
                         "dependencies": ["p1_phase1_step1"]
-                    }}}}
+                    }}
                 ]
-            }}}}
+            }}
         ]
 
         Important guidelines:
@@ -245,12 +104,276 @@ class ProcessDecompositionAgent:
         6. Include any specific roles or responsibilities mentioned
         7. Maintain proper sequencing of steps
 
+        Respond only with the JSON array following the exact format shown above.
+
         Document content to analyze:
-        {document.content}
+        {content}
+        """
 
-        Respond only with the JSON array following the exact format shown above.
+def _normalize_process(p: dict, process_index: int) -> dict:
+    """
+    Fill in the fields a decoded process needs before validation: default ids,
+    names and descriptions, phases derived from sub-process IDs and a phase_id
+    for every sub-process. The dict is modified in place and returned.
+    """
+    # Ensure required fields
+    p["id"] = p.get("id", str(process_index))
+    p["name"] = p.get("name", f"Process {process_index + 1}")
+    p["description"] = p.get("description", "No description provided")
+    p["sub_processes"] = p.get("sub_processes", [])
+
+    # Ensure each sub-process has required fields, collecting the
+    # phase number encoded in each sub-process ID as a parallel list
+    sub_processes = p["sub_processes"]
+    phase_nums = []
+    for idx, sub in enumerate(sub_processes):
+        sub["id"] = sub.get("id", f"{p['id']}_sub_{idx}")
+        sub["name"] = sub.get("name", f"Step {idx + 1}")
+        sub["description"] = sub.get("description", "No description provided")
+        sub["order"] = sub.get("order", idx + 1)
+
+        match = _PHASE_RE.search(sub["id"])
+        phase_nums.append(match.group(1) if match else None)
+
+    # Create phases if they don't exist, one per distinct phase number
+    # in order of first appearance, then sorted by number
+    if "phases" not in p:
+        unique_nums = dict.fromkeys(num for num in phase_nums if num is not None)
+        p["phases"] = [
+            {
+                "id": f"{p['id']}_phase{phase_num}",
+                "name": f"Fase {phase_num}",
+                "description": f"Fase {phase_num} del proceso",
+                "order": int(phase_num),
+                "objectives": []
+            }
+            for phase_num in sorted(unique_nums, key=int)
+        ]
+
+    # Assign phase_id based on sub-process ID pattern
+    for sub, phase_num in zip(sub_processes, phase_nums):
+        if phase_num is not None:
+            sub["phase_id"] = f"{p['id']}_phase{phase_num}"
+        else:
+            # If no phase in ID, assign to first phase or create one
+            if not p["phases"]:
+                default_phase = {
+                    "id": f"{p['id']}_phase1",
+                    "name": "Fase 1",
+                    "description": "Fase principal del proceso",
+                    "order": 1,
+                    "objectives": []
+                }
+                p["phases"].append(default_phase)
+            sub["phase_id"] = p["phases"][0]["id"]
+    
+    return p
+
+class ContentValidator:
+    pass
+
+class ProcessDecompositionAgent:
+    def __init__(self, api_key: str, cache_enabled: bool = True,
+                 model: Optional[GenerativeModel] = None,
+                 cache_dir: Optional[str] = None):
+        self.model = model or get_model(api_key)
+        self.content_validator = ContentValidator()
+        self.cache = ResponseCache(cache_dir) if cache_enabled else None
+        
+    def _parse_processes(self, json_str: str) -> List[Process]:
+        """Parse JSON string into Process objects with error handling"""
+        logger.debug(f"Attempting to parse JSON: {json_str}")
+        
+        try:
+            processes_data = orjson.loads(json_str)
+            if not isinstance(processes_data, list):
+                raise ValueError(f"Expected JSON array, got {type(processes_data)}")
+            
+            for process_index, p in enumerate(processes_data):
+                if not isinstance(p, dict):
+                    raise ValueError(f"Expected dict for process, got {type(p)}")
+                _normalize_process(p, process_index)
+            
+            return _PROCESS_LIST_ADAPTER.validate_python(processes_data)
+            
+        except orjson.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            logger.error(f"Problematic JSON: {json_str}")
+            raise ValueError(f"Invalid JSON format: {e}")
+        except Exception as e:
+            logger.error(f"Error parsing processes: {e}")
+            logger.error(f"Input data: {json_str}")
+            raise ValueError(f"Error creating processes: {e}")
+
+    def _find_extracted_values(self, document: Document, processes_data: list) -> Set[str]:
+        """
+        Return the lowercased string values of the extracted processes that occur
+        in the document text.
+        
+        Values containing a word the document never uses are discarded up front;
+        the rest are matched in a single Aho-Corasick pass over the text instead
+        of one substring scan per value.
+        """
+        tokens = document.content_tokens
+        automaton = ahocorasick.Automaton()
+        for process_data in processes_data:
+            if not isinstance(process_data, dict):
+                continue
+            for value in process_data.values():
+                if isinstance(value, str) and value:
+                    needle = value.lower()
+                    # Only inner words are necessarily whole words of the text;
+                    # the first and last may be cut by a substring match
+                    if any(word not in tokens for word in WORD_RE.findall(needle)[1:-1]):
+                        continue
+                    automaton.add_word(needle, needle)
+        
+        if len(automaton) == 0:
+            return set()
+        automaton.make_automaton()
+        return {needle for _, needle in automaton.iter(document.content_lower)}
+
+    def _validate_extraction(self, found_values: Set[str], extracted_info: dict) -> bool:
+        """Validate that extracted information exists in original text"""
+        # Check each piece of extracted information
+        for key, value in extracted_info.items():
+            if key in _NON_EXTRACTED_FIELDS:
+                continue
+            if isinstance(value, str) and value:
+                lowered = value.lower()
+                if lowered in found_values or lowered.strip() in _PLACEHOLDER_VALUES:
+                    continue
+                logger.warning(f"Potentially hallucinated content in {key}: {value}")
+                return False
+        return True
+
+    def _cache_lookup(self, prompt: str, refresh: bool):
+        """Return the cache key for `prompt` and its cached response, if any"""
+        if self.cache is None:
+            return None, None
+        cache_key = self.cache.make_key(prompt, self.model.model_name)
+        return cache_key, None if refresh else self.cache.get(cache_key)
+
+    async def call_api(self, prompt: str, refresh: bool = False,
+                       parse: Optional[Callable[[str], Any]] = None) -> Any:
+        """
+        Call the Gemini API and return the response text.
+        
+        Cached responses are reused unless `refresh` is set, in which case the
+        API is called again and the cached entry replaced. When `parse` is given
+        the parsed response is returned instead, and a response is only cached
+        once it parses, so a malformed answer is never replayed.
+        """
+        cache_key, cached = self._cache_lookup(prompt, refresh)
+        if cached is not None:
+            return parse(cached) if parse else cached
+        
+        try:
+            # Stream the response so chunks are read as they are generated
+            response = await self.model.generate_content_async(prompt, stream=True)
+            text = "".join([chunk.text async for chunk in response])
+        except Exception as e:
+            logger.error(f"API call failed: {str(e)}")
+            raise
+        
+        result = parse(text) if parse else text
+        if cache_key is not None:
+            self.cache.set(cache_key, text)
+        return result
+
+    def call_api_sync(self, prompt: str, refresh: bool = False,
+                      parse: Optional[Callable[[str], Any]] = None) -> Any:
+        """Synchronous version of call_api"""
+        cache_key, cached = self._cache_lookup(prompt, refresh)
+        if cached is not None:
+            return parse(cached) if parse else cached
+        
+        try:
+            response = self.model.generate_content(prompt, stream=True)
+            text = "".join(chunk.text for chunk in response)
+        except Exception as e:
+            logger.error(f"API call failed: {str(e)}")
+            raise
+        
+        result = parse(text) if parse else text
+        if cache_key is not None:
+            self.cache.set(cache_key, text)
+        return result
+
+    def _extract_processes(self, document: Document, response_text: str) -> List[Process]:
+        """
+        Decode the processes in a response, keep those validated against the
+        document and normalize them. A malformed or empty answer raises
+        ValueError whatever went wrong, so the caller can retry it.
+        """
+        try:
+            processes_data = orjson.loads(clean_json_string(response_text))
+            if not isinstance(processes_data, list):
+                raise ValueError(f"Expected JSON array, got {type(processes_data)}")
+            
+            # Validate each process against original text
+            found_values = self._find_extracted_values(document, processes_data)
+            valid_processes = []
+            for process_data in processes_data:
+                if not isinstance(process_data, dict):
+                    continue
+                if self._validate_extraction(found_values, process_data):
+                    valid_processes.append(
+                        _normalize_process(process_data, len(valid_processes)))
+                else:
+                    logger.warning(f"Removing invalid process: {process_data.get('name')}")
+            
+            if not valid_processes:
+                raise ValueError("No valid processes in response")
+            return _PROCESS_LIST_ADAPTER.validate_python(valid_processes)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f"Error creating processes: {e}") from e
+
+    async def analyze_document(self, document: Document) -> List[Process]:
+        """
+        Analyze the document content and extract processes with strict validation.
         """
+        prompt = _ANALYZE_PROMPT_TEMPLATE.format(content=document.content)
+        
+        max_attempts = 3
+        for attempt in range(max_attempts):
+            try:
+                # A retry must reach the model again rather than replay the cached response
+                return await self.call_api(prompt, refresh=attempt > 0,
+                                           parse=partial(self._extract_processes, document))
+            except ValueError as e:
+                logger.error(f"Attempt {attempt + 1}: Error processing response - {str(e)}")
+        
+        # If all attempts fail, return an empty list
+        logger.error("Failed to extract valid processes after all attempts")
+        return []
+
+    async def analyze_documents(self, documents: List[Document],
+                                max_concurrent: int = 10) -> List[List[Process]]:
+        """
+        Analyze several documents concurrently.
+        
+        Args:
+            documents: Documents to analyze
+            max_concurrent: Maximum number of documents analyzed at the same time
+            
+        Returns:
+            The extracted processes for each document, in the same order
+        """
+        semaphore = asyncio.Semaphore(max_concurrent)
+        
+        async def analyze_one(document: Document) -> List[Process]:
+            async with semaphore:
+                return await self.analyze_document(document)
+        
+        return await asyncio.gather(*(analyze_one(document) for document in documents))
+
+    def analyze_document_sync(self, document: Document) -> List[Process]:
+        """Synchronous version of analyze_document"""
+        prompt = _ANALYZE_SYNC_PROMPT_TEMPLATE.format(content=document.content)
         
-        response = self.call_api(prompt)
-        json_str = self._clean_json_string(response.text)
-        return self._parse_processes(json_str)
+        return self.call_api_sync(
+            prompt, parse=lambda response_text: self._parse_processes(clean_json_string(response_text))
+        )
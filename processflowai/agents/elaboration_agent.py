@@ -1,11 +1,15 @@
-from typing import Dict, List
-import google.generativeai as genai
+from typing import Any, Callable, Dict, List, Optional
+import asyncio
+from google.generativeai import GenerativeModel
 import logging
 from ..models.process import Process, SubProcess, ProcessStatus
-from ratelimit import limits, sleep_and_retry
-import time
-from datetime import datetime, timedelta
+from ..utils.api_manager import AsyncRateLimiter, is_rate_limit_error
+from ..utils.async_utils import run_sync
+from ..utils.cache import ResponseCache
+from ..utils.gemini_client import get_model
+from ..utils.json_utils import clean_json_string
 import json
+import re
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -16,12 +20,35 @@ CALLS_PER_MINUTE = 15
 CALLS_PER_DAY = 1500
 TOKENS_PER_MINUTE = 1_000_000
 
+# Maximum number of sub-processes elaborated in a single API call
+SUBPROCESS_BATCH_SIZE = 10
+# Maximum number of attempts to elaborate sub-processes missing from a response
+MAX_RETRIES = 3
+
+# Numeración que el modelo antepone a un paso ("1.", "2)"); un número seguido
+# solo de un espacio es parte del texto ("10 minutos de espera")
+STEP_NUMBER_PREFIX = re.compile(r"^\d+[.)]\s*")
+
+# Heurística local para estimar duraciones sin llamar a la API
+_STEP_RE = re.compile(r"^\s*\d+[.)]", re.M)
+MINUTES_PER_STEP = 5
+# Minutos adicionales por cada paso que implica esperas o intervención de terceros
+DURATION_KEYWORDS = {
+    "esperar": 30,
+    "aprobación": 60,
+    "aprobar": 60,
+    "revisar": 15,
+}
+
 class ProcessElaborationAgent:
-    def __init__(self, api_key: str):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+    def __init__(self, api_key: str, cache_enabled: bool = True,
+                 model: Optional[GenerativeModel] = None,
+                 cache_dir: Optional[str] = None):
+        self.model = model or get_model(api_key)
+        self.rate_limiter = AsyncRateLimiter(CALLS_PER_MINUTE, CALLS_PER_DAY)
+        self.cache = ResponseCache(cache_dir) if cache_enabled else None
     
-    def _elaborate_process_description(self, process: Process) -> str:
+    async def _elaborate_process_description(self, process: Process) -> str:
         """Elaborate on the main process description"""
         prompt = f"""
         Basándote ÚNICAMENTE en esta información del proceso, genera una descripción clara y detallada:
@@ -39,26 +66,112 @@ class ProcessElaborationAgent:
         7. Si algo no está claro o falta información, NO intentar completarla
         """
         
-        try:
-            response = self.call_api(prompt)
-            return response.text.strip()
-        except Exception as e:
-            logger.error(f"Error elaborating process description: {str(e)}")
-            return process.description
+        for attempt in range(MAX_RETRIES):
+            try:
+                # A retry must reach the model again rather than replay the cached response
+                return await self.call_api(prompt, refresh=attempt > 0,
+                                           parse=self._parse_description)
+            except Exception as e:
+                logger.error(f"Attempt {attempt + 1}: Error elaborating process description: {str(e)}")
+        return process.description
+
+    async def _elaborate_process_descriptions(self, processes: List[Process]) -> List[str]:
+        """
+        Elaborate the main description of several processes in one API call.
+        
+        Processes missing from the response are asked for again; any still
+        missing after MAX_RETRIES attempts keep their current description.
+        """
+        elaborated = {}
+        pending = processes
+        for attempt in range(MAX_RETRIES):
+            try:
+                results = await self.call_api(self._descriptions_prompt(pending),
+                                              refresh=attempt > 0, parse=self._parse_json_array)
+                for item in results:
+                    if item.get("description"):
+                        elaborated[str(item.get("id"))] = str(item["description"]).strip()
+            except Exception as e:
+                logger.error(f"Attempt {attempt + 1}: Error elaborating process descriptions: {str(e)}")
+            
+            pending = [process for process in pending if process.id not in elaborated]
+            if not pending:
+                break
+        
+        return [elaborated.get(process.id, process.description) for process in processes]
 
-    def _elaborate_subprocess(self, sub_process: SubProcess, process_context: str) -> str:
-        """Elaborate on a sub-process with detailed step-by-step instructions"""
+    @staticmethod
+    def _descriptions_prompt(processes: List[Process]) -> str:
+        """Build the prompt elaborating the main description of `processes`"""
+        process_list = "\n".join(
+            f"""
+        - id: {process.id}
+          Nombre del Proceso: {process.name}
+          Descripción Actual: {process.description}
+          Categoría: {process.category if process.category else 'No especificada'}"""
+            for process in processes
+        )
+        return f"""
+        Basándote ÚNICAMENTE en la información de cada proceso, genera una descripción clara y detallada:
+        {process_list}
+        
+        REGLAS ESTRICTAS:
+        1. SOLO incluir información que esté EXPLÍCITAMENTE mencionada en el input
+        2. NO agregar pasos, requisitos o detalles que no estén en el texto original
+        3. NO hacer suposiciones sobre el proceso
+        4. NO incluir información de conocimiento general o experiencia previa
+        5. Mantener el mismo significado y alcance del texto original
+        6. Usar un lenguaje claro y profesional
+        7. Si algo no está claro o falta información, NO intentar completarla
+        
+        Responde SOLO con un arreglo JSON con un objeto por proceso, en el mismo orden
+        y copiando el id EXACTAMENTE:
+        [
+            {{
+                "id": "id del proceso",
+                "description": "Descripción elaborada"
+            }}
+        ]
+        """
+
+    async def _elaborate_subprocesses_batch(self, sub_processes: List[SubProcess],
+                                            process_context: str,
+                                            refresh: bool = False,
+                                            precise: bool = False) -> List[dict]:
+        """
+        Elaborate several sub-processes in one API call.
+        
+        Durations are only requested from the model when `precise` is set;
+        otherwise they are estimated locally by `_estimate_duration_local`.
+        """
+        if precise:
+            duration_rules = """
+        Estima además una duración realista para cada subproceso considerando la complejidad
+        de la tarea, las interacciones con sistemas, los pasos manuales vs automatizados y
+        los posibles tiempos de espera (ej. "15 minutos", "1 hora", "2-3 días").
+"""
+            duration_field = ',\n                "estimated_duration": "15 minutos"'
+        else:
+            duration_rules = ""
+            duration_field = ""
+        subprocess_list = "\n".join(
+            f"""
+        - id: {sub_process.id}
+          Subproceso: {sub_process.name}
+          Descripción Base: {sub_process.description}
+          Orden: {sub_process.order}"""
+            for sub_process in sub_processes
+        )
         prompt = f"""
-        Basándote ÚNICAMENTE en esta información del subproceso:
+        Basándote ÚNICAMENTE en esta información de los subprocesos:
 
         Contexto del Proceso Principal:
         {process_context}
 
-        Subproceso: {sub_process.name}
-        Descripción Base: {sub_process.description}
-        Orden: {sub_process.order}
+        Subprocesos:
+        {subprocess_list}
 
-        Genera instrucciones paso a paso detalladas siguiendo estas reglas ESTRICTAS:
+        Para CADA subproceso genera instrucciones paso a paso detalladas siguiendo estas reglas ESTRICTAS:
 
         REGLAS CRÍTICAS DE CONTENIDO:
         1. SOLO incluir pasos que estén EXPLÍCITAMENTE mencionados en el input
@@ -75,6 +188,7 @@ class ProcessElaborationAgent:
         3. NO repetir números
         4. Cada paso debe comenzar con un verbo en infinitivo
         5. Mantener el texto EXACTAMENTE como aparece en el input
+        6. Separar los pasos con saltos de línea (\\n)
 
         EJEMPLO CORRECTO (si el input dice exactamente esto):
         Input: "Abrir inventario, hacer clic en nuevo, escribir proveedor"
@@ -88,136 +202,222 @@ class ProcessElaborationAgent:
         2. Ingresar credenciales  <-- MAL: No mencionado en el input
         3. Navegar al módulo de inventario  <-- MAL: No mencionado en el input
         4. Abrir inventario
+{duration_rules}
+        Responde SOLO con un arreglo JSON con un objeto por subproceso, en el mismo orden
+        y copiando el id EXACTAMENTE:
+        [
+            {{
+                "id": "id del subproceso",
+                "description": "1. Paso\\n2. Paso"{duration_field}
+            }}
+        ]
         """
         
         try:
-            response = self.call_api(prompt)
-            description = response.text.strip()
-            
-            # Procesar la respuesta para asegurar formato correcto
-            lines = description.split('\n')
-            processed_lines = []
-            
-            for line in lines:
-                line = line.strip()
-                if not line:  # Ignorar líneas vacías
-                    continue
-                
-                # Limpiar cualquier numeración existente
-                if line[0].isdigit():
-                    # Si la línea comienza con un número, eliminar la numeración
-                    parts = line.split('.')
-                    if len(parts) > 1:
-                        line = '.'.join(parts[1:]).strip()
-                    else:
-                        # Buscar el primer espacio después del número
-                        space_index = line.find(' ')
-                        if space_index != -1:
-                            line = line[space_index:].strip()
-                
-                # Agregar la línea sin numeración
-                if line:
-                    processed_lines.append(line)
-            
-            return '\n'.join(processed_lines)
+            return await self.call_api(prompt, refresh=refresh, parse=self._parse_json_array)
         except Exception as e:
-            logger.error(f"Error elaborating subprocess: {str(e)}")
-            return sub_process.description
+            logger.error(f"Error elaborating subprocess batch: {str(e)}")
+            return []
 
-    def _estimate_duration(self, description: str) -> str:
-        """Estimate duration based on the step description"""
-        prompt = f"""
-        Based on this step description, estimate a realistic duration:
-        {description}
+    @staticmethod
+    def _parse_description(response_text: str) -> str:
+        """Return the elaborated description, rejecting an empty response"""
+        description = response_text.strip()
+        if not description:
+            raise ValueError("Empty description in response")
+        return description
+
+    @staticmethod
+    def _parse_json_array(response_text: str) -> List[dict]:
+        """Return the objects of the JSON array in a response"""
+        results = json.loads(clean_json_string(response_text))
+        if not isinstance(results, list):
+            raise ValueError(f"Expected JSON array, got {type(results)}")
+        return [item for item in results if isinstance(item, dict)]
+
+    @staticmethod
+    def _strip_step_numbering(description: str) -> str:
+        """Remove blank lines and any numbering the model added to each step"""
+        processed_lines = []
         
-        Consider:
-        1. Complexity of the task
-        2. Required system interactions
-        3. Manual vs automated steps
-        4. Potential waiting times
+        for line in description.strip().split('\n'):
+            # Limpiar cualquier numeración existente
+            line = STEP_NUMBER_PREFIX.sub('', line.strip(), count=1)
+            
+            # Agregar la línea sin numeración, ignorando líneas vacías
+            if line:
+                processed_lines.append(line)
         
-        Respond with ONLY the estimated duration in a clear format (e.g., "15 minutes", "1 hour", "2-3 days").
-        """
+        return '\n'.join(processed_lines)
+
+    @staticmethod
+    def _estimate_duration_local(description: str) -> str:
+        """Estimate a sub-process duration from its steps without calling the API"""
+        lines = [line for line in description.split('\n') if line.strip()]
+        steps = len(_STEP_RE.findall(description)) or len(lines) or 1
+        minutes = steps * MINUTES_PER_STEP
         
-        try:
-            response = self.call_api(prompt)
-            return response.text.strip()
-        except Exception as e:
-            logger.error(f"Error estimating duration: {str(e)}")
-            return "Duration not specified"
+        text = description.lower()
+        for keyword, extra_minutes in DURATION_KEYWORDS.items():
+            minutes += text.count(keyword) * extra_minutes
+        
+        if minutes < 60:
+            return f"{minutes} minutos"
+        hours = round(minutes / 60, 1)
+        if hours == int(hours):
+            hours = int(hours)
+        return "1 hora" if hours == 1 else f"{hours} horas"
 
-    @sleep_and_retry
-    @limits(calls=15, period=60)
-    def call_api(self, *args, **kwargs):
-        """Call the API with rate limiting"""
+    async def call_api(self, prompt: str, refresh: bool = False,
+                       parse: Optional[Callable[[str], Any]] = None) -> Any:
+        """
+        Call the API with rate limiting and return the response text.
+        
+        Cached responses are reused unless `refresh` is set, in which case the
+        API is called again and the cached entry replaced. When `parse` is given
+        the parsed response is returned instead, and a response is only cached
+        once it parses, so a malformed answer is never replayed.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(prompt, self.model.model_name)
+            cached = None if refresh else self.cache.get(cache_key)
+            if cached is not None:
+                return parse(cached) if parse else cached
+        
         try:
-            current_time = datetime.now()
-            if not hasattr(self, 'last_call_time') or current_time.minute != self.last_call_time.minute:
-                self.calls_this_minute = 1
-                self.last_call_time = current_time
-            else:
-                self.calls_this_minute += 1
-            
-            if not hasattr(self, 'today') or current_time.date() != self.today:
-                self.today = current_time.date()
-                self.calls_today = 1
-            else:
-                self.calls_today += 1
-            
-            if self.calls_today > CALLS_PER_DAY:
-                logger.error("Daily rate limit exceeded. Please try again tomorrow.")
-                raise Exception("Daily rate limit exceeded")
-            
-            return self.model.generate_content(*args, **kwargs)
+            # Stream the response so chunks are read as they are generated
+            async with self.rate_limiter:
+                response = await self.model.generate_content_async(prompt, stream=True)
+                chunks = [chunk.text async for chunk in response]
+            text = "".join(chunks)
         except Exception as e:
-            if "429" in str(e) or "Resource has been exhausted" in str(e):
+            if is_rate_limit_error(e):
                 logger.warning("Rate limit exceeded. Implementing exponential backoff...")
-                wait_time = min(300, 2 ** (self.calls_this_minute / CALLS_PER_MINUTE * 10))
+                wait_time = self.rate_limiter.backoff_time()
                 logger.info(f"Waiting {wait_time:.2f} seconds before retrying...")
-                time.sleep(wait_time)
+                await self.rate_limiter.throttle(wait_time)
                 raise Exception(f"Rate limit exceeded. Retry after {wait_time:.2f} seconds") from e
             raise
+        
+        result = parse(text) if parse else text
+        if cache_key is not None:
+            self.cache.set(cache_key, text)
+        return result
 
-    async def elaborate_process(self, process: Process) -> Process:
-        """Elaborate on a process and its sub-processes using Gemini."""
+    async def elaborate_process(self, process: Process, precise: bool = False) -> Process:
+        """
+        Elaborate on a process and its sub-processes using Gemini.
+        
+        Sub-process durations are estimated locally unless `precise` is set,
+        in which case the model estimates them along with the descriptions and
+        any duration it omits is still estimated locally.
+        """
         try:
-            process.description = self._elaborate_process_description(process)
-            
-            process_context = f"""
-            Proceso Principal: {process.name}
-            Descripción: {process.description}
-            Categoría: {process.category if process.category else 'No especificada'}
-            """
-            
-            for sub_process in process.sub_processes:
-                sub_process.description = self._elaborate_subprocess(sub_process, process_context)
-                
-                if not sub_process.estimated_duration:
-                    sub_process.estimated_duration = self._estimate_duration(sub_process.description)
-            
-            return process
+            process = process.model_copy(
+                update={"description": await self._elaborate_process_description(process)}
+            )
+            return await self._elaborate_sub_processes(process, precise)
         except Exception as e:
             logger.error(f"Error in elaborate_process: {str(e)}")
             return process
 
-    def elaborate_process_sync(self, process: Process) -> Process:
-        """Synchronous version of elaborate_process"""
-        try:
-            process.description = self._elaborate_process_description(process)
+    async def elaborate_processes_batch(self, processes: List[Process],
+                                        precise: bool = False) -> List[Process]:
+        """
+        Elaborate several processes, describing all of them in a single API call.
+        
+        The sub-processes of each process are then elaborated concurrently. A
+        process whose elaboration fails is returned unchanged.
+        """
+        if not processes:
+            return []
+        
+        descriptions = await self._elaborate_process_descriptions(processes)
+        described = [process.model_copy(update={"description": description})
+                     for process, description in zip(processes, descriptions)]
+        
+        results = await asyncio.gather(
+            *(self._elaborate_sub_processes(process, precise) for process in described),
+            return_exceptions=True
+        )
+        
+        elaborated_processes = []
+        for process, result in zip(described, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error elaborating process {process.id}: {result}")
+                result = process
+            elaborated_processes.append(result)
+        return elaborated_processes
+
+    async def _elaborate_sub_processes(self, process: Process, precise: bool) -> Process:
+        """Elaborate the sub-processes of a process whose description is already elaborated"""
+        process_context = f"""
+        Proceso Principal: {process.name}
+        Descripción: {process.description}
+        Categoría: {process.category if process.category else 'No especificada'}
+        """
+        
+        # Un solo llamado por lote de subprocesos; los lotes se lanzan en paralelo
+        # y el limitador de la API acota cuántos avanzan a la vez
+        sub_processes = process.sub_processes
+        elaborated = {}
+        pending = sub_processes
+        previous_missing = None
+        for attempt in range(MAX_RETRIES):
+            batches = [pending[i:i + SUBPROCESS_BATCH_SIZE]
+                       for i in range(0, len(pending), SUBPROCESS_BATCH_SIZE)]
+            results = await asyncio.gather(
+                *(self._elaborate_subprocesses_batch(batch, process_context,
+                                                    refresh=attempt > 0, precise=precise)
+                  for batch in batches),
+                return_exceptions=True
+            )
             
-            process_context = f"""
-            Proceso Principal: {process.name}
-            Descripción: {process.description}
-            Categoría: {process.category if process.category else 'No especificada'}
-            """
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Error elaborating subprocess batch: {result}")
+                    continue
+                for item in result:
+                    elaborated[str(item.get("id"))] = item
             
-            for sub_process in process.sub_processes:
-                sub_process.description = self._elaborate_subprocess(sub_process, process_context)
-                
-                if not sub_process.estimated_duration:
-                    sub_process.estimated_duration = self._estimate_duration(sub_process.description)
+            pending = [sub for sub in pending if sub.id not in elaborated]
+            if not pending:
+                break
             
-            return process
-        except Exception as e:
-            logger.error(f"Error in elaborate_process_sync: {str(e)}")
-            return process
+            missing = {sub.id for sub in pending}
+            if missing == previous_missing:
+                logger.warning(f"No progress elaborating subprocesses {sorted(missing)}, giving up")
+                break
+            previous_missing = missing
+            logger.warning(f"Attempt {attempt + 1}: {len(pending)} subprocesses missing from response")
+        
+        updated_sub_processes = []
+        for sub_process in sub_processes:
+            item = elaborated.get(sub_process.id)
+            if item is None:
+                logger.warning(f"No elaboration returned for subprocess {sub_process.id}")
+                # The local estimate needs no API call, so it still applies
+                if not sub_process.estimated_duration:
+                    sub_process = sub_process.model_copy(update={
+                        "estimated_duration": self._estimate_duration_local(sub_process.description)
+                    })
+                updated_sub_processes.append(sub_process)
+                continue
+            updates = {}
+            if item.get("description"):
+                updates["description"] = self._strip_step_numbering(str(item["description"]))
+            if not sub_process.estimated_duration:
+                if item.get("estimated_duration"):
+                    updates["estimated_duration"] = str(item["estimated_duration"])
+                else:
+                    # Also when the model was asked for a duration but omitted it
+                    updates["estimated_duration"] = self._estimate_duration_local(
+                        str(item.get("description") or sub_process.description))
+            updated_sub_processes.append(sub_process.model_copy(update=updates))
+        
+        return process.model_copy(update={"sub_processes": updated_sub_processes})
+
+    def elaborate_process_sync(self, process: Process, precise: bool = False) -> Process:
+        """Synchronous version of elaborate_process"""
+        return run_sync(self.elaborate_process(process, precise=precise))
@@ -1,25 +1,134 @@
-from typing import List, Optional
+from typing import Any, List, Optional
 from uuid import uuid4
+import hashlib
+import logging
+from pydantic import TypeAdapter
 from .models.process import Document, Process
 from .agents.decomposition_agent import ProcessDecompositionAgent
 from .agents.elaboration_agent import ProcessElaborationAgent
 from .utils.api_manager import APIRateLimiter
+from .utils.async_utils import run_sync
+from .utils.cache import ResponseCache
+from .utils.gemini_client import get_model
+
+logger = logging.getLogger(__name__)
+
+# Agent results are reused for a week before the model is asked again
+RESULT_CACHE_TTL = 7 * 24 * 60 * 60
+
+_PROCESS_LIST_ADAPTER = TypeAdapter(List[Process])
+
+def _is_elaborated(process: Process, elaborated: Process) -> bool:
+    """
+    Whether the agent managed to elaborate `process` and all its sub-processes.
+    
+    The agent keeps the original description of a process or sub-process whose
+    elaboration failed, so any unchanged description means the result is only
+    partial and must not be cached; the next call retries it instead.
+    """
+    if elaborated.description == process.description:
+        return False
+    original_descriptions = {sub.id: sub.description for sub in process.sub_processes}
+    return all(sub.description != original_descriptions.get(sub.id)
+               for sub in elaborated.sub_processes)
+
+class CachedAgent:
+    """
+    Wrap an agent so its results are served from the response cache.
+    
+    Results are keyed by a SHA-256 of the tag, the model name and the exact
+    input, so a re-uploaded document or an unchanged process skips the API
+    entirely. Bump the tag when prompts or parsing change to invalidate old
+    entries. Any other attribute is forwarded to the wrapped agent.
+    """
+    
+    def __init__(self, agent: Any, cache: ResponseCache, tag: str,
+                 ttl: float = RESULT_CACHE_TTL):
+        self.agent = agent
+        self.cache = cache
+        self.tag = tag
+        self.ttl = ttl
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.agent, name)
+    
+    def _key(self, payload: str) -> str:
+        key_source = f"{self.tag}\0{self.agent.model.model_name}\0{payload}"
+        return hashlib.sha256(key_source.encode()).hexdigest()
+    
+    async def analyze_document(self, document: Document) -> List[Process]:
+        """Cached version of the agent's analyze_document"""
+        key = self._key(document.content)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return _PROCESS_LIST_ADAPTER.validate_json(cached)
+        
+        processes = await self.agent.analyze_document(document)
+        # An empty result means extraction failed; let the next call retry it
+        if processes:
+            self.cache.set(key, _PROCESS_LIST_ADAPTER.dump_json(processes).decode(), self.ttl)
+        return processes
+    
+    async def elaborate_process(self, process: Process, precise: bool = False) -> Process:
+        """Cached version of the agent's elaborate_process"""
+        key = self._key(f"{precise}\0{process.model_dump_json()}")
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Process.model_validate_json(cached)
+        
+        elaborated = await self.agent.elaborate_process(process, precise=precise)
+        if _is_elaborated(process, elaborated):
+            self.cache.set(key, elaborated.model_dump_json(), self.ttl)
+        return elaborated
+    
+    async def elaborate_processes_batch(self, processes: List[Process],
+                                        precise: bool = False) -> List[Process]:
+        """Cached version of the agent's elaborate_processes_batch"""
+        keys = [self._key(f"{precise}\0{process.model_dump_json()}") for process in processes]
+        results: List[Optional[Process]] = []
+        for key in keys:
+            cached = self.cache.get(key)
+            results.append(None if cached is None else Process.model_validate_json(cached))
+        
+        # Only the processes missing from the cache go to the agent, in one batch
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            elaborated = await self.agent.elaborate_processes_batch(
+                [processes[i] for i in missing], precise=precise
+            )
+            for i, process in zip(missing, elaborated):
+                results[i] = process
+                if _is_elaborated(processes[i], process):
+                    self.cache.set(keys[i], process.model_dump_json(), self.ttl)
+        return results
 
 class ProcessFlowAI:
     def __init__(self, 
                  api_key: str,
-                 calls_per_minute: int = 60):
+                 calls_per_minute: int = 60,
+                 cache_enabled: bool = True,
+                 cache_dir: Optional[str] = None):
         """
         Initialize ProcessFlowAI application.
         
         Args:
             api_key: Gemini API key
             calls_per_minute: Rate limit for API calls
+            cache_enabled: Reuse cached responses for identical prompts and
+                cached results for identical documents and processes
+            cache_dir: Directory of the cache; defaults to the PFAI_CACHE_DIR
+                environment variable, or .pfai_cache in the working directory
         """
-        self.decomposition_agent = ProcessDecompositionAgent(api_key)
-        self.elaboration_agent = ProcessElaborationAgent(api_key)
+        model = get_model(api_key)
+        self.decomposition_agent = ProcessDecompositionAgent(api_key, cache_enabled, model, cache_dir)
+        self.elaboration_agent = ProcessElaborationAgent(api_key, cache_enabled, model, cache_dir)
         self.rate_limiter = APIRateLimiter(calls_per_minute)
         
+        if cache_enabled:
+            result_cache = ResponseCache(cache_dir)
+            self.decomposition_agent = CachedAgent(self.decomposition_agent, result_cache, "decomp-v1")
+            self.elaboration_agent = CachedAgent(self.elaboration_agent, result_cache, "elab-v1")
+        
     async def process_document(self, 
                              content: str, 
                              title: Optional[str] = None) -> Document:
@@ -35,7 +144,7 @@ class ProcessFlowAI:
         """
         # Create document
         doc = Document(
-            id=str(uuid4()),
+            id=uuid4().hex,
             title=title or "Untitled Document",
             content=content,
             processes=[]
@@ -47,38 +156,22 @@ class ProcessFlowAI:
             doc
         )
         
-        # Elaborate on each process
-        elaborated_processes = []
-        for process in processes:
-            elaborated_process = await self.rate_limiter.execute(
-                self.elaboration_agent.elaborate_process,
-                process
+        # Elaborate all processes together: one call for their descriptions,
+        # then their sub-processes concurrently
+        try:
+            elaborated_processes = await self.rate_limiter.execute(
+                self.elaboration_agent.elaborate_processes_batch,
+                processes
             )
-            elaborated_processes.append(elaborated_process)
+        except Exception as e:
+            # Keep the extracted processes when elaboration failed
+            logger.error(f"Error elaborating processes: {e}")
+            elaborated_processes = processes
         
-        doc.processes = elaborated_processes
-        return doc
+        return doc.model_copy(update={"processes": elaborated_processes})
     
     def process_document_sync(self,
                             content: str,
                             title: Optional[str] = None) -> Document:
         """Synchronous version of process_document"""
-        # Create document
-        doc = Document(
-            id=str(uuid4()),
-            title=title or "Untitled Document",
-            content=content,
-            processes=[]
-        )
-        
-        # Extract processes
-        processes = self.decomposition_agent.analyze_document_sync(doc)
-        
-        # Elaborate on each process
-        elaborated_processes = []
-        for process in processes:
-            elaborated_process = self.elaboration_agent.elaborate_process_sync(process)
-            elaborated_processes.append(elaborated_process)
-        
-        doc.processes = elaborated_processes
-        return doc
+        return run_sync(self.process_document(content=content, title=title))
@@ -1,7 +1,14 @@
-from typing import List, Optional, Dict
-from pydantic import BaseModel, Field
+from typing import Any, List, Optional, Dict, FrozenSet
+from functools import cached_property
+import re
+from pydantic import BaseModel, ConfigDict, Field
 from enum import Enum
 
+WORD_RE = re.compile(r"\w+")
+
+# Los modelos son inmutables: se actualizan con model_copy(update=...)
+FROZEN_CONFIG = ConfigDict(frozen=True, extra='ignore')
+
 class ProcessStatus(str, Enum):
     """Estado del proceso o subproceso"""
     NOT_STARTED = "No iniciado"
@@ -19,12 +26,14 @@ class RiskLevel(str, Enum):
 
 class ValidationCriteria(BaseModel):
     """Criterios de validación para un subproceso"""
+    model_config = FROZEN_CONFIG
     description: str = Field(..., description="Descripción del criterio")
     expected_result: str = Field(..., description="Resultado esperado")
     validation_method: Optional[str] = Field(None, description="Método de validación")
 
 class Resource(BaseModel):
     """Recurso necesario para un subproceso"""
+    model_config = FROZEN_CONFIG
     name: str = Field(..., description="Nombre del recurso")
     type: str = Field(..., description="Tipo de recurso (humano, material, sistema, etc.)")
     quantity: Optional[str] = Field(None, description="Cantidad necesaria")
@@ -32,6 +41,7 @@ class Resource(BaseModel):
 
 class Phase(BaseModel):
     """Representa una fase dentro de un proceso"""
+    model_config = FROZEN_CONFIG
     id: str = Field(..., description="Identificador único de la fase")
     name: str = Field(..., description="Nombre de la fase")
     description: str = Field(..., description="Descripción detallada de la fase")
@@ -41,6 +51,7 @@ class Phase(BaseModel):
 
 class ProcessMetrics(BaseModel):
     """Métricas y KPIs del proceso"""
+    model_config = FROZEN_CONFIG
     total_duration: str = Field(..., description="Duración total estimada")
     critical_path: List[str] = Field(default_factory=list, description="IDs de los pasos en la ruta crítica")
     risk_level: RiskLevel = Field(default=RiskLevel.LOW, description="Nivel de riesgo del proceso")
@@ -49,6 +60,7 @@ class ProcessMetrics(BaseModel):
 
 class SubProcess(BaseModel):
     """Representa un subproceso dentro de un proceso principal"""
+    model_config = FROZEN_CONFIG
     id: str = Field(..., description="Identificador único del subproceso")
     phase_id: str = Field(..., description="ID de la fase a la que pertenece")
     name: str = Field(..., description="Nombre del subproceso")
@@ -67,6 +79,7 @@ class SubProcess(BaseModel):
 
 class Process(BaseModel):
     """Representa un proceso principal extraído del documento"""
+    model_config = FROZEN_CONFIG
     id: str = Field(..., description="Identificador único del proceso")
     name: str = Field(..., description="Nombre del proceso")
     description: str = Field(..., description="Descripción detallada del proceso")
@@ -82,8 +95,12 @@ class Process(BaseModel):
     stakeholders: List[str] = Field(default_factory=list, description="Interesados en el proceso")
     documentation: Dict[str, str] = Field(default_factory=dict, description="Enlaces a documentación relacionada")
 
+# Propiedades de Document calculadas a partir del contenido y guardadas en la instancia
+_CONTENT_PROPERTIES = ('content_lower', 'content_tokens')
+
 class Document(BaseModel):
     """Representa un documento subido con procesos extraídos"""
+    model_config = FROZEN_CONFIG
     id: str = Field(..., description="Identificador único del documento")
     title: str = Field(..., description="Título del documento")
     content: str = Field(..., description="Contenido original del documento")
@@ -92,3 +109,20 @@ class Document(BaseModel):
     updated_at: Optional[str] = Field(None, description="Última actualización")
     version: Optional[str] = Field(None, description="Versión del documento")
     tags: List[str] = Field(default_factory=list, description="Etiquetas o categorías")
+
+    @cached_property
+    def content_lower(self) -> str:
+        """Contenido en minúsculas, calculado una sola vez para las validaciones"""
+        return self.content.lower()
+
+    @cached_property
+    def content_tokens(self) -> FrozenSet[str]:
+        """Palabras del contenido en minúsculas, para descartar valores ausentes sin recorrer el texto"""
+        return frozenset(WORD_RE.findall(self.content_lower))
+
+    def model_copy(self, *, update: Optional[Dict[str, Any]] = None, deep: bool = False) -> 'Document':
+        """Copiar el documento sin arrastrar los valores derivados del contenido anterior"""
+        copy = super().model_copy(update=update, deep=deep)
+        for name in _CONTENT_PROPERTIES:
+            copy.__dict__.pop(name, None)
+        return copy
@@ -1,7 +1,9 @@
 import streamlit as st
 import asyncio
+import io
+import operator
+from collections import defaultdict
 from typing import Optional
-import json
 from pathlib import Path
 import sys
 import os
@@ -10,9 +12,13 @@ from utils.word_generator import generate_process_document
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from processflowai.agents.elaboration_agent import STEP_NUMBER_PREFIX
 from processflowai.app import ProcessFlowAI
 from processflowai.models.process import Document, Process, SubProcess
 
+# Clave de ordenamiento para fases y subprocesos
+_BY_ORDER = operator.attrgetter('order')
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="ProcessFlowAI",
@@ -27,40 +33,49 @@ if 'app' not in st.session_state:
 if 'current_document' not in st.session_state:
     st.session_state.current_document = None
 
-def display_process(process: Process):
-    """Display a process and its sub-processes in the UI"""
-    st.markdown(f"## {process.name}")
+@st.cache_data(ttl=3600, hash_funcs={Process: lambda p: p.model_dump_json()})
+def _render_process_md(process: Process) -> str:
+    """Build the Markdown for a process and its sub-processes, cached by content"""
+    parts = [f"## {process.name}"]
     
     if process.phases:
-        st.markdown("### Pasos Detallados:")
+        parts.append("### Pasos Detallados:")
         
-        for phase_index, phase in enumerate(sorted(process.phases, key=lambda x: x.order), 1):
+        # Agrupar los subprocesos por fase una sola vez, ya ordenados
+        phase_to_subs = defaultdict(list)
+        for sub in process.sub_processes:
+            phase_to_subs[sub.phase_id].append(sub)
+        for phase_subs in phase_to_subs.values():
+            phase_subs.sort(key=_BY_ORDER)
+        
+        sorted_phases = sorted(process.phases, key=_BY_ORDER)
+        for phase_index, phase in enumerate(sorted_phases, 1):
             # Display sub-processes for this phase
-            phase_steps = [sub for sub in process.sub_processes if sub.phase_id == phase.id]
+            phase_steps = phase_to_subs.get(phase.id, [])
             if phase_steps:
-                for sub_index, sub in enumerate(sorted(phase_steps, key=lambda x: x.order), 1):
+                for sub_index, sub in enumerate(phase_steps, 1):
                     # Mostrar título del subproceso con numeración jerárquica
-                    st.markdown(f"\n**{phase_index}.{sub_index}. {sub.name}**")
+                    parts.append(f"**{phase_index}.{sub_index}. {sub.name}**")
                     
                     if sub.description:
                         # Reiniciar contador para los pasos dentro de cada subproceso
-                        step_counter = 1
+                        steps = []
                         for line in sub.description.split('\n'):
                             line = line.strip()
                             if line:
                                 # Eliminar cualquier numeración existente
-                                if line[0].isdigit():
-                                    parts = line.split('.')
-                                    if len(parts) > 1:
-                                        line = '.'.join(parts[1:]).strip()
-                                    else:
-                                        space_index = line.find(' ')
-                                        if space_index != -1:
-                                            line = line[space_index:].strip()
+                                line = STEP_NUMBER_PREFIX.sub('', line, count=1)
                                 
                                 # Agregar nueva numeración para el paso
-                                st.markdown(f"{step_counter}. {line}")
-                                step_counter += 1
+                                steps.append(f"{len(steps) + 1}. {line}")
+                        if steps:
+                            parts.append('\n'.join(steps))
+    
+    return '\n\n'.join(parts)
+
+def display_process(process: Process):
+    """Display a process and its sub-processes in the UI"""
+    st.markdown(_render_process_md(process))
 
     # Export to Word
     if st.button(" Exportar a Word", key=f"export_word_{process.name}_{id(process)}"):
@@ -73,14 +88,24 @@ def display_process(process: Process):
                     'order': subprocess.order
                 })
             
-            filepath = generate_process_document(
+            # Reutilizar el documento ya generado si el contenido no cambió
+            word_cache = st.session_state.setdefault("word_cache", {})
+            cache_key = (
+                process.id,
                 process.name,
                 process.description,
-                subprocesses_data
+                tuple((sub['name'], sub['description'], sub['order']) for sub in subprocesses_data)
             )
-            
-            with open(filepath, 'rb') as f:
-                bytes_data = f.read()
+            if cache_key not in word_cache:
+                buffer = io.BytesIO()
+                generate_process_document(
+                    process.name,
+                    process.description,
+                    subprocesses_data,
+                    stream=buffer
+                )
+                word_cache[cache_key] = buffer.getvalue()
+            bytes_data = word_cache[cache_key]
             
             st.download_button(
                 label=" Descargar Documento Word",
@@ -99,8 +124,8 @@ def save_document(doc: Document):
     output_dir.mkdir(exist_ok=True)
     
     file_path = output_dir / f"{doc.id}.json"
-    with open(file_path, 'w') as f:
-        json.dump(doc.model_dump(), f, indent=2)
+    with open(file_path, 'wb') as f:
+        f.write(doc.model_dump_json(indent=2).encode('utf-8'))
     
     return file_path
 
@@ -199,7 +224,7 @@ def main():
             # Export options
             st.download_button(
                 "Download JSON",
-                data=json.dumps(doc.model_dump(), indent=2),
+                data=doc.model_dump_json(indent=2).encode('utf-8'),
                 file_name=f"{doc.id}.json",
                 mime="application/json",
                 key="download_json_button"
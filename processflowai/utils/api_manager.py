@@ -1,23 +1,71 @@
 import asyncio
 from typing import TypeVar, Callable, Awaitable, Any
-from datetime import datetime, timedelta
 import logging
 import random
+import time
+from aiolimiter import AsyncLimiter
+from google.api_core import exceptions as google_exceptions
 
 T = TypeVar('T')
 
 logger = logging.getLogger(__name__)
 
+# Upper bound in seconds for a retry backoff after a rate limit error
+BACKOFF_CAP = 60.0
+# 2 ** 6 already exceeds the cap; larger exponents are clamped
+MAX_BACKOFF_EXPONENT = 6
+# Seconds after a refill during which a call that fits is admitted without refilling
+FAST_PATH_WINDOW = 0.1
+
+# Exceptions the Google client raises when a quota is exhausted (HTTP 429)
+_RATE_LIMIT_EXC = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Return True if `error` reports an exhausted API quota"""
+    if isinstance(error, _RATE_LIMIT_EXC) or getattr(error, "code", None) == 429:
+        return True
+    # Errors raised by other layers only carry the status in their message
+    message = str(error)
+    return "429" in message or "Resource has been exhausted" in message
+
 class APIRateLimiter:
+    """
+    Rate limiter for API calls with retries and exponential backoff.
+    
+    Each quota (requests per minute, tokens per minute, requests per day) is a
+    token bucket that refills continuously at its rate and holds at most its
+    limit, so checking and recording a call is a single O(1) `_try_acquire`.
+    """
+    
+    __slots__ = (
+        'calls_per_minute', 'tokens_per_minute', 'calls_per_day', 'max_retries',
+        '_rpm_tokens', '_tpm_tokens', '_rpd_tokens', '_last_refill',
+        '_rpm_rate', '_tpm_rate', '_rpd_rate',
+        '_warn_rpm_tokens', '_warn_tpm_tokens', '_warn_rpd_tokens', '_lock',
+    )
+    
     def __init__(self, calls_per_minute: int = 15, max_retries: int = 3,
                  tokens_per_minute: int = 1_000_000, calls_per_day: int = 1500):
         self.calls_per_minute = calls_per_minute
         self.tokens_per_minute = tokens_per_minute
         self.calls_per_day = calls_per_day
         self.max_retries = max_retries
-        self.minute_calls = []
-        self.day_calls = []
-        self.minute_tokens = []
+        # Tokens currently available in each bucket; all start full
+        self._rpm_tokens = float(calls_per_minute)
+        self._tpm_tokens = float(tokens_per_minute)
+        self._rpd_tokens = float(calls_per_day)
+        self._last_refill = time.monotonic()
+        # Refill rates in tokens per second
+        self._rpm_rate = calls_per_minute / 60
+        self._tpm_rate = tokens_per_minute / 60
+        self._rpd_rate = calls_per_day / 86400
+        # A bucket below a quarter of its limit is over 75% used, the level
+        # at which usage is logged as a warning
+        self._warn_rpm_tokens = calls_per_minute * 0.25
+        self._warn_tpm_tokens = tokens_per_minute * 0.25
+        self._warn_rpd_tokens = calls_per_day * 0.25
+        # Guards the check-and-take on the buckets; never held while sleeping
+        self._lock = asyncio.Lock()
         
     async def execute(self, func: Callable[..., Awaitable[T]], *args, 
                      expected_tokens: int = 0, **kwargs) -> T:
@@ -32,26 +80,36 @@ class APIRateLimiter:
             
         Returns:
             Result from the function call
+            
+        Raises:
+            ValueError: If expected_tokens exceeds tokens_per_minute, since the
+                call could never be admitted
         """
+        if expected_tokens > self.tokens_per_minute:
+            raise ValueError(
+                f"expected_tokens ({expected_tokens}) exceeds the limit of "
+                f"{self.tokens_per_minute} tokens per minute"
+            )
+        
         retry_count = 0
         last_error = None
         
         while retry_count <= self.max_retries:
             try:
+                # Reserves this call's slot before it starts, so concurrent
+                # callers cannot all pass the same check
                 await self._wait_if_needed(expected_tokens)
-                result = await func(*args, **kwargs)
-                self._record_call(expected_tokens)
-                return result
+                return await func(*args, **kwargs)
                 
             except Exception as e:
                 last_error = e
                 retry_count += 1
                 
-                if "429" in str(e) or "Resource has been exhausted" in str(e):
-                    # Calculate exponential backoff with jitter
-                    base_wait = 2 ** retry_count
-                    jitter = random.uniform(0, min(base_wait, 10))  # Cap jitter at 10 seconds
-                    wait_time = base_wait + jitter
+                if is_rate_limit_error(e):
+                    # Exponential backoff with full jitter: concurrent retries spread
+                    # uniformly over the window instead of clustering at its start
+                    backoff = 2 ** min(retry_count, MAX_BACKOFF_EXPONENT)
+                    wait_time = random.uniform(0, min(BACKOFF_CAP, backoff))
                     
                     logger.warning(f"Rate limit exceeded. Retrying in {wait_time:.2f} seconds... "
                                  f"(Attempt {retry_count} of {self.max_retries})")
@@ -71,99 +129,214 @@ class APIRateLimiter:
         logger.error(f"Failed after {retry_count} attempts. Last error: {last_error}")
         raise last_error
     
-    def _record_call(self, tokens: int = 0):
-        """Record a successful API call and token usage"""
-        now = datetime.now()
-        
-        # Record minute-based metrics
-        self.minute_calls.append(now)
-        if tokens > 0:
-            self.minute_tokens.append((now, tokens))
-            
-        # Record daily calls
-        self.day_calls.append(now)
-        
-        # Clean up old records
-        self._cleanup_records()
+    def _try_acquire(self, tokens: int, now: float) -> float:
+        """
+        Refill the buckets and take one call and `tokens` from them if possible.
         
-        # Log current API usage
-        self._log_usage()
-    
-    def _cleanup_records(self):
-        """Clean up old records"""
-        now = datetime.now()
-        minute_ago = now - timedelta(minutes=1)
-        day_ago = now - timedelta(days=1)
+        Returns 0.0 when the call was admitted, otherwise the seconds until the
+        slowest bucket will have refilled its shortfall. Bucket state is read
+        and written once, so the whole check is a single call on locals.
+        """
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        rpm = min(self.calls_per_minute, self._rpm_tokens + elapsed * self._rpm_rate)
+        tpm = min(self.tokens_per_minute, self._tpm_tokens + elapsed * self._tpm_rate)
+        rpd = min(self.calls_per_day, self._rpd_tokens + elapsed * self._rpd_rate)
         
-        # Clean up minute-based records
-        self.minute_calls = [call for call in self.minute_calls if call > minute_ago]
-        self.minute_tokens = [(time, tokens) for time, tokens in self.minute_tokens 
-                            if time > minute_ago]
+        wait_time = max((1 - rpm) / self._rpm_rate,
+                        (tokens - tpm) / self._tpm_rate,
+                        (1 - rpd) / self._rpd_rate)
+        if wait_time <= 0:
+            rpm -= 1
+            tpm -= tokens
+            rpd -= 1
+            wait_time = 0.0
         
-        # Clean up daily records
-        self.day_calls = [call for call in self.day_calls if call > day_ago]
+        self._rpm_tokens = rpm
+        self._tpm_tokens = tpm
+        self._rpd_tokens = rpd
+        return wait_time
     
     def _log_usage(self):
         """Log current API usage statistics"""
-        minute_calls = len(self.minute_calls)
-        day_calls = len(self.day_calls)
-        minute_tokens = sum(tokens for _, tokens in self.minute_tokens)
+        # Nothing to report below the warning level unless debug logging is on
+        if (self._rpm_tokens >= self._warn_rpm_tokens
+                and self._tpm_tokens >= self._warn_tpm_tokens
+                and self._rpd_tokens >= self._warn_rpd_tokens
+                and not logger.isEnabledFor(logging.DEBUG)):
+            return
+        
+        # Usage is the part of each bucket that has not refilled yet
+        minute_calls = round(self.calls_per_minute - self._rpm_tokens)
+        day_calls = round(self.calls_per_day - self._rpd_tokens)
+        minute_tokens = round(self.tokens_per_minute - self._tpm_tokens)
         
         # Calculate usage percentages
         rpm_usage = (minute_calls / self.calls_per_minute) * 100
         tpm_usage = (minute_tokens / self.tokens_per_minute) * 100
         rpd_usage = (day_calls / self.calls_per_day) * 100
         
-        # Log based on highest usage
+        # Log based on highest usage; arguments are only formatted if emitted
         max_usage = max(rpm_usage, tpm_usage, rpd_usage)
-        if max_usage > 90:
+        if max_usage > 75:
             logger.warning(
-                f"Critical API usage: {minute_calls}/{self.calls_per_minute} RPM "
-                f"({rpm_usage:.1f}%), {minute_tokens}/{self.tokens_per_minute} TPM "
-                f"({tpm_usage:.1f}%), {day_calls}/{self.calls_per_day} RPD "
-                f"({rpd_usage:.1f}%)"
-            )
-        elif max_usage > 75:
-            logger.warning(
-                f"High API usage: {minute_calls}/{self.calls_per_minute} RPM "
-                f"({rpm_usage:.1f}%), {minute_tokens}/{self.tokens_per_minute} TPM "
-                f"({tpm_usage:.1f}%), {day_calls}/{self.calls_per_day} RPD "
-                f"({rpd_usage:.1f}%)"
+                "%s API usage: %d/%d RPM (%.1f%%), %d/%d TPM (%.1f%%), %d/%d RPD (%.1f%%)",
+                "Critical" if max_usage > 90 else "High",
+                minute_calls, self.calls_per_minute, rpm_usage,
+                minute_tokens, self.tokens_per_minute, tpm_usage,
+                day_calls, self.calls_per_day, rpd_usage
             )
         else:
             logger.debug(
-                f"Current API usage: {minute_calls}/{self.calls_per_minute} RPM, "
-                f"{minute_tokens}/{self.tokens_per_minute} TPM, "
-                f"{day_calls}/{self.calls_per_day} RPD"
+                "Current API usage: %d/%d RPM, %d/%d TPM, %d/%d RPD",
+                minute_calls, self.calls_per_minute,
+                minute_tokens, self.tokens_per_minute,
+                day_calls, self.calls_per_day
             )
     
     async def _wait_if_needed(self, expected_tokens: int = 0):
-        """Wait if we're approaching any rate limits"""
+        """
+        Wait until every bucket holds enough tokens for the call, then take them.
+        
+        A caller short of tokens sleeps once for the time the slowest bucket
+        needs to refill the shortfall, then checks again. The lock only covers
+        the check and the deduction, so waiters sleep concurrently.
+        """
         while True:
-            now = datetime.now()
-            self._cleanup_records()
-            
-            # Check minute-based limits
-            if len(self.minute_calls) >= self.calls_per_minute:
-                wait_time = (self.minute_calls[0] + timedelta(minutes=1) - now).total_seconds()
-                logger.info(f"RPM limit reached. Waiting {wait_time:.2f} seconds...")
-                await asyncio.sleep(wait_time)
-                continue
+            async with self._lock:
+                now = time.monotonic()
+                # Fast path: shortly after a refill, a call that fits in every
+                # bucket is taken directly. _last_refill is left alone, so the
+                # skipped time still accrues on the next refill
+                if (now - self._last_refill < FAST_PATH_WINDOW
+                        and self._rpm_tokens >= 1
+                        and self._tpm_tokens >= expected_tokens
+                        and self._rpd_tokens >= 1):
+                    self._rpm_tokens -= 1
+                    self._tpm_tokens -= expected_tokens
+                    self._rpd_tokens -= 1
+                    self._log_usage()
+                    return
                 
-            # Check token limit
-            current_tokens = sum(tokens for _, tokens in self.minute_tokens)
-            if current_tokens + expected_tokens > self.tokens_per_minute:
-                wait_time = (self.minute_tokens[0][0] + timedelta(minutes=1) - now).total_seconds()
-                logger.info(f"TPM limit approaching. Waiting {wait_time:.2f} seconds...")
-                await asyncio.sleep(wait_time)
-                continue
-                
-            # Check daily limit
-            if len(self.day_calls) >= self.calls_per_day:
-                wait_time = (self.day_calls[0] + timedelta(days=1) - now).total_seconds()
+                # Check and take atomically so concurrent callers cannot
+                # both pass the same check
+                wait_time = self._try_acquire(expected_tokens, now)
+                if wait_time == 0.0:
+                    self._log_usage()
+                    return
+                daily_limit_reached = self._rpd_tokens < 1
+            
+            # Sleep outside the lock so other callers can take tokens as they refill
+            if daily_limit_reached:
                 logger.error(f"Daily limit reached. Waiting {wait_time:.2f} seconds...")
-                await asyncio.sleep(wait_time)
-                continue
-                
-            # If we get here, we're good to proceed
-            break
+            else:
+                logger.info(f"Rate limit reached. Waiting {wait_time:.2f} seconds...")
+            await asyncio.sleep(wait_time)
+
+
+class AsyncRateLimiter:
+    """
+    Async admission control for calls made through a single API client.
+    
+    Used as ``async with limiter:`` around each request. The minute quota is a
+    token bucket, the daily quota resets every 24 hours, and after a 429 the
+    number of calls allowed in flight shrinks until `recovery_time` has elapsed.
+    """
+    
+    def __init__(self, calls_per_minute: int = 15, calls_per_day: int = 1500,
+                 recovery_time: float = 60.0):
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day
+        self.recovery_time = recovery_time
+        self.minute_limiter = None
+        self.available_slots = calls_per_minute
+        self.in_flight = 0
+        self.calls_today = 0
+        self._day_start = time.monotonic()
+        self._throttle_count = 0
+        self._last_throttle = 0.0
+        self._condition = None
+        self._loop = None
+        self._recovery_tasks = set()
+    
+    async def __aenter__(self) -> "AsyncRateLimiter":
+        self._count_daily_call()
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.available_slots)
+            self.in_flight += 1
+        try:
+            await self.minute_limiter.acquire()
+        except BaseException:
+            await self._release()
+            raise
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._release()
+    
+    def backoff_time(self) -> float:
+        """
+        Seconds to wait after a rate-limit response.
+        
+        Doubles with each consecutive 429 and starts over once `recovery_time`
+        has passed without one.
+        """
+        now = time.monotonic()
+        if now - self._last_throttle > self.recovery_time:
+            self._throttle_count = 0
+        self._throttle_count += 1
+        self._last_throttle = now
+        return min(300.0, 2.0 ** self._throttle_count)
+    
+    async def throttle(self, wait_time: float):
+        """
+        Back off after a rate-limit response.
+        
+        Removes one in-flight slot until `recovery_time` has elapsed, then
+        sleeps `wait_time` seconds without blocking the event loop.
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.available_slots = max(1, self.available_slots - 1)
+        task = asyncio.create_task(self._restore_slot())
+        self._recovery_tasks.add(task)
+        task.add_done_callback(self._recovery_tasks.discard)
+        await asyncio.sleep(wait_time)
+    
+    def _get_condition(self) -> asyncio.Condition:
+        """Return the admission condition for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio primitives belong to a single loop, and the sync wrappers
+            # start a fresh one per call via asyncio.run
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.minute_limiter = AsyncLimiter(self.calls_per_minute, 60)
+            self.available_slots = self.calls_per_minute
+            self.in_flight = 0
+            self._recovery_tasks = set()
+        return self._condition
+    
+    def _count_daily_call(self):
+        """Count a call against the daily quota, resetting it every 24 hours"""
+        now = time.monotonic()
+        if now - self._day_start >= 86400:
+            self._day_start = now
+            self.calls_today = 0
+        
+        if self.calls_today >= self.calls_per_day:
+            logger.error("Daily rate limit exceeded. Please try again tomorrow.")
+            raise Exception("Daily rate limit exceeded")
+        self.calls_today += 1
+    
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+    
+    async def _restore_slot(self):
+        await asyncio.sleep(self.recovery_time)
+        async with self._condition:
+            self.available_slots = min(self.calls_per_minute, self.available_slots + 1)
+            self._condition.notify_all()
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+from typing import Awaitable, Optional, TypeVar
+
+T = TypeVar('T')
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop, starting its thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="processflowai-loop",
+                             daemon=True).start()
+        return _loop
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    Run a coroutine to completion from synchronous code and return its result.
+
+    Every call runs on the same background event loop rather than a new one per
+    call, so async clients and limiters bound to a loop keep working across
+    calls. This also works when the caller's thread already runs a loop, as
+    Streamlit's may.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = ".pfai_cache"
+# Environment variable overriding the default cache directory
+CACHE_DIR_ENV = "PFAI_CACHE_DIR"
+# Entries stored without an explicit TTL expire after 30 days
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# Once the cache holds more entries than this, the oldest writes are evicted
+DEFAULT_MAX_ENTRIES = 10_000
+# Expired and excess entries are pruned on open and after this many writes
+PRUNE_INTERVAL = 100
+
+class ResponseCache:
+    """
+    Persistent cache of model responses.
+    
+    Entries are keyed by a hash of the prompt and the model name, so an
+    identical request is answered from disk instead of calling the API again.
+    Every entry expires after its TTL, and the cache is pruned back to
+    `max_entries` by dropping the entries written longest ago.
+    
+    The cache lives in `directory`, or in the directory named by the
+    PFAI_CACHE_DIR environment variable, or in DEFAULT_CACHE_DIR.
+    """
+    
+    def __init__(self, directory: Optional[str] = None,
+                 default_ttl: float = DEFAULT_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        directory = directory or os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "responses.sqlite3"),
+            check_same_thread=False
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            # Caches created before TTL support lack the expiry column
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+            if "expires_at" not in columns:
+                self._conn.execute("ALTER TABLE responses ADD COLUMN expires_at REAL")
+            # Entries written without an expiry get the default one from now on
+            self._conn.execute(
+                "UPDATE responses SET expires_at = ? WHERE expires_at IS NULL",
+                (time.time() + default_ttl,)
+            )
+            self._prune()
+    
+    @staticmethod
+    def make_key(prompt: str, model_name: str) -> str:
+        """Fingerprint a request by its prompt and model"""
+        return hashlib.blake2b((prompt + model_name).encode(), digest_size=16).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for `key`, or None on a miss"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            logger.debug(f"Cache entry {key} expired")
+            return None
+        logger.debug(f"Cache hit for {key}")
+        return value
+    
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        """Store the response for `key`, expiring after `ttl` seconds (default_ttl if not given)"""
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            self._writes += 1
+            if self._writes % PRUNE_INTERVAL == 0:
+                self._prune()
+    
+    def _prune(self):
+        """Delete expired entries and the oldest ones beyond max_entries; the caller holds the lock"""
+        self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        # REPLACE re-inserts a row, so the rowid order is the write order
+        self._conn.execute(
+            "DELETE FROM responses WHERE rowid IN "
+            "(SELECT rowid FROM responses ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
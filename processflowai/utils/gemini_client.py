@@ -0,0 +1,15 @@
+from functools import lru_cache
+import google.generativeai as genai
+
+DEFAULT_MODEL_NAME = 'gemini-1.5-flash'
+
+@lru_cache(maxsize=None)
+def get_model(api_key: str, model_name: str = DEFAULT_MODEL_NAME) -> genai.GenerativeModel:
+    """
+    Return the shared GenerativeModel for an API key and model name.
+    
+    The API is configured and the model built only once, so every agent using
+    it shares the same underlying client and its open connections.
+    """
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
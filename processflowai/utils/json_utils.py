@@ -0,0 +1,23 @@
+import re
+
+# First fenced code block, with an optional "json" language tag
+_FENCE_RE = re.compile(r"```(?:json)?(.*?)```", re.S)
+
+def clean_json_string(text: str) -> str:
+    """Clean and extract a JSON array from a model response"""
+    # Remove any markdown code blocks
+    match = _FENCE_RE.search(text)
+    if match:
+        text = match.group(1)
+    elif "```" in text:
+        # Unterminated code block: keep what follows the fence
+        text = text.split("```", 1)[1]
+    
+    # Ensure we have valid JSON array brackets
+    text = text.strip()
+    if not text.startswith("["):
+        text = "[" + text
+    if not text.endswith("]"):
+        text = text + "]"
+        
+    return text.strip()
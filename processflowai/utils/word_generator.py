@@ -1,22 +1,72 @@
 from docx import Document
 from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-import os
+from docx.oxml import OxmlElement
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+import zipfile
+
+# Directorio de salida de los documentos; se crea una sola vez, al primer uso
+_DOCS_DIR = Path(__file__).resolve().parent.parent / 'docs'
+_DOCS_DIR_READY = False
+
+# Documento base ya configurado, serializado al crear el primer generador
+_TEMPLATE_BYTES = None
+# Partes del zip de la plantilla, en orden, y la estructura del paquete que
+# las produjo; todas salvo el cuerpo son idénticas en cada documento generado
+_TEMPLATE_PARTS = None
+_TEMPLATE_SIGNATURE = None
+_DOCUMENT_PART = 'word/document.xml'
+
+def _document_path(process_name):
+    """Ruta del archivo en el que se guarda el documento de un proceso"""
+    return str(_DOCS_DIR / f"{process_name.replace(' ', '_')}.docx")
+
+def _package_signature(document):
+    """Nombres de las partes del paquete y relaciones del documento principal"""
+    package = document.part.package
+    return (
+        frozenset(str(part.partname) for part in package.iter_parts()),
+        frozenset((r_id, rel.reltype, rel.target_ref) for r_id, rel in document.part.rels.items())
+    )
+
+def _cache_template_parts(template_bytes, document):
+    """Guardar las partes del zip de la plantilla y la estructura de su paquete"""
+    global _TEMPLATE_PARTS, _TEMPLATE_SIGNATURE
+    with zipfile.ZipFile(BytesIO(template_bytes)) as package:
+        _TEMPLATE_PARTS = [(info.filename, package.read(info)) for info in package.infolist()]
+    _TEMPLATE_SIGNATURE = _package_signature(document)
 
 class WordGenerator:
+    __slots__ = ('document',)
+    _ONE_INCH = Inches(1)
+
     def __init__(self):
-        self.document = Document()
-        self._setup_document()
+        global _TEMPLATE_BYTES
+        if _TEMPLATE_BYTES is None:
+            self.document = Document()
+            self._setup_document()
+            buffer = BytesIO()
+            self.document.save(buffer)
+            _TEMPLATE_BYTES = buffer.getvalue()
+            _cache_template_parts(_TEMPLATE_BYTES, self.document)
+        else:
+            # Partir de la plantilla ya configurada en lugar de repetir la configuración
+            self.document = Document(BytesIO(_TEMPLATE_BYTES))
 
     def _setup_document(self):
         """Configurar el estilo del documento"""
         # Configurar márgenes
         sections = self.document.sections
         for section in sections:
-            section.top_margin = Inches(1)
-            section.bottom_margin = Inches(1)
-            section.left_margin = Inches(1)
-            section.right_margin = Inches(1)
+            section.top_margin = self._ONE_INCH
+            section.bottom_margin = self._ONE_INCH
+            section.left_margin = self._ONE_INCH
+            section.right_margin = self._ONE_INCH
+        
+        # Tamaño de los títulos de sección
+        self.document.styles['Heading 1'].font.size = Pt(14)
 
     def add_title(self, title):
         """Agregar título principal"""
@@ -28,14 +78,23 @@ class WordGenerator:
     def add_process_section(self, title, content):
         """Agregar una sección del proceso"""
         # Agregar título de sección
-        heading = self.document.add_heading(title, level=1)
-        heading.style.font.size = Pt(14)
+        self.document.add_heading(title, level=1)
         
         # Agregar contenido
         if isinstance(content, list):
+            # Crear los párrafos directamente en el XML, sin los objetos
+            # Paragraph/Run intermedios, antes de las propiedades de sección
+            body = self.document.element.body
+            sect_pr = body.sectPr
             for item in content:
-                p = self.document.add_paragraph()
-                p.add_run(item)
+                p = OxmlElement('w:p')
+                r = OxmlElement('w:r')
+                r.text = item
+                p.append(r)
+                if sect_pr is not None:
+                    sect_pr.addprevious(p)
+                else:
+                    body.append(p)
         else:
             p = self.document.add_paragraph()
             p.add_run(content)
@@ -50,7 +109,27 @@ class WordGenerator:
         """Guardar el documento"""
         self.document.save(filepath)
 
-def generate_process_document(process_name, process_description, subprocesses):
+    def _fast_save(self, filepath):
+        """
+        Guardar reutilizando las partes ya serializadas de la plantilla.
+
+        Solo se serializa el cuerpo del documento, por lo que únicamente es válido
+        cuando nada más que el cuerpo cambió desde la plantilla (como en
+        generate_process_document); cambios en estilos o propiedades se perderían.
+        Si el paquete ya no tiene la estructura de la plantilla (p. ej. se
+        agregaron imágenes o enlaces) se guarda de la forma habitual.
+        """
+        if _TEMPLATE_PARTS is None or _package_signature(self.document) != _TEMPLATE_SIGNATURE:
+            self.document.save(filepath)
+            return
+        
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as package:
+            for name, data in _TEMPLATE_PARTS:
+                if name == _DOCUMENT_PART:
+                    data = self.document.part.blob
+                package.writestr(name, data)
+
+def generate_process_document(process_name, process_description, subprocesses, stream=None):
     """
     Generar documento Word con la descripción del proceso
     
@@ -58,6 +137,11 @@ def generate_process_document(process_name, process_description, subprocesses):
         process_name (str): Nombre del proceso
         process_description (str): Descripción del proceso
         subprocesses (list): Lista de subprocesos con sus descripciones
+        stream (file-like, opcional): Si se indica, el documento se escribe en
+            él (p. ej. un BytesIO) en lugar de guardarse en disco
+    
+    Returns:
+        La ruta del archivo generado, o el stream si se indicó uno
     """
     generator = WordGenerator()
     
@@ -70,26 +154,68 @@ def generate_process_document(process_name, process_description, subprocesses):
     # Agregar desarrollo del proceso
     generator.add_process_section("2. DESARROLLO DEL PROCESO", "")
     
-    # Agregar subprocesos
+    # Agregar subprocesos, reuniendo sus criterios de control en la misma pasada
+    controls = []
     for i, subprocess in enumerate(subprocesses, 1):
         generator.add_process_section(
             f"2.{i}. {subprocess['name']}", 
             subprocess['description']
         )
+        if 'control' in subprocess:
+            controls.append(subprocess['control'])
     
     # Agregar criterios de control si existen
-    if any('control' in sub for sub in subprocesses):
-        generator.add_process_section(
-            "3. CRITERIOS DE CONTROL",
-            [sub['control'] for sub in subprocesses if 'control' in sub]
-        )
+    if controls:
+        generator.add_process_section("3. CRITERIOS DE CONTROL", controls)
+    
+    # Escribir en memoria sin pasar por el disco
+    if stream is not None:
+        generator._fast_save(stream)
+        return stream
     
     # Crear directorio para documentos si no existe
-    docs_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'docs')
-    os.makedirs(docs_dir, exist_ok=True)
+    global _DOCS_DIR_READY
+    if not _DOCS_DIR_READY:
+        _DOCS_DIR.mkdir(parents=True, exist_ok=True)
+        _DOCS_DIR_READY = True
     
     # Guardar documento
-    filepath = os.path.join(docs_dir, f"{process_name.replace(' ', '_')}.docx")
-    generator.save(filepath)
+    filepath = _document_path(process_name)
+    generator._fast_save(filepath)
     
     return filepath
+
+def _generate_from_spec(spec):
+    """Generar un documento a partir de una tupla de argumentos (usado por el pool)"""
+    return generate_process_document(*spec)
+
+def generate_process_documents(specs, max_workers=None):
+    """
+    Generar varios documentos Word en paralelo, cada uno en un proceso del pool
+    
+    Args:
+        specs (list): Tuplas (process_name, process_description, subprocesses)
+            con los argumentos de generate_process_document
+        max_workers (int, opcional): Número máximo de procesos; por defecto,
+            uno por núcleo
+    
+    Returns:
+        Las rutas de los archivos generados, en el mismo orden que specs
+    """
+    # Procesos con el mismo nombre se guardan en el mismo archivo; como al
+    # generarlos en serie, prevalece el último, y así dos procesos del pool
+    # nunca escriben a la vez en la misma ruta
+    unique_specs = {}
+    for spec in specs:
+        unique_specs[_document_path(spec[0])] = spec
+    unique_specs = list(unique_specs.values())
+    
+    # Con un solo documento no compensa arrancar el pool
+    if len(unique_specs) < 2:
+        for spec in unique_specs:
+            _generate_from_spec(spec)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_generate_from_spec, unique_specs))
+    
+    return [_document_path(spec[0]) for spec in specs]
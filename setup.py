@@ -8,5 +8,8 @@ setup(
         "streamlit>=1.31.0",
         "google-generativeai>=0.3.0",
         "pydantic>=2.0.0",
+        "aiolimiter>=1.1.0",
+        "pyahocorasick>=2.0.0",
+        "orjson>=3.9.0",
     ],
 )